@@ -1,7 +1,13 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 import app.utils as f
 
-appl = FastAPI()
+@asynccontextmanager
+async def lifespan(appl: FastAPI):
+    va.start_drift_checker()
+    yield
+
+appl = FastAPI(lifespan=lifespan)
 
 # todo: add read path from command line
 va = f.VectorAgent("/mnt/d/dev/github/vector-agent/app/config.yaml")
@@ -14,6 +20,14 @@ def api_vector_validate_config_branch(branch: str):
 def api_apply_synced_config():
     return va.apply_synced_config()
 
+@appl.get("/diff/{hash}")
+def api_diff_config(hash: str):
+    return va.diff_config(hash)
+
+@appl.get("/drift")
+def api_check_config_drift():
+    return va.check_config_drift()
+
 @appl.get("/status")
 def api_status():
     return va.get_status()
\ No newline at end of file
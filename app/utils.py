@@ -8,6 +8,9 @@ import time
 import sys
 import logging
 import platform
+import hashlib
+import json
+import threading
 
 logger = logging.getLogger(__name__)
 FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
@@ -24,10 +27,13 @@ default_synced_config_dir =     "01-synced"
 default_hold_config_dir =       "02-hold"
 default_valid_config_dir =      "03-valid"
 default_active_config_dir =     "04-active"
+default_digests_dir =           "digests"
 default_reload_method = "auto"
 default_reload_timeout = 60*2 #2 minutes
 default_vector_configs_workdir = "/opt/vector-agent/vector-confdir"
 default_apply_rules_config_name = "apply-rules.yaml"
+default_drift_check_interval = 60 #1 minute
+hash_chunk_size = 1024*1024
 
 class VectorAgent:
     def __init__(self, config_path):
@@ -54,6 +60,14 @@ class VectorAgent:
         self._apply_status = ""
         self._gitsync_env_files = []
         self._repo_use_gitsync_settings = False
+        self._drift_check_interval = default_drift_check_interval
+        self._active_merkle_tree = None
+        self._active_snapshot_tree = None
+        self._merkle_tree_cache = {}
+        self._active_scan_tree = None
+        self._config_drift = None
+        self._lock = threading.Lock()
+        self._digests_lock = threading.RLock()
 
         # load values from Agent config
         self._load_config(config_path)
@@ -63,6 +77,9 @@ class VectorAgent:
         self._valid_config_path = os.path.join(self._vector_configs_workdir, default_valid_config_dir)
         self._active_config_path = os.path.join(self._vector_configs_workdir, default_active_config_dir)
         self._apply_rules_config_path = os.path.join(self._synced_config_path, self._apply_rules_config_name)
+        self._digests_path = os.path.join(self._vector_configs_workdir, default_digests_dir)
+        os.makedirs(self._digests_path, exist_ok=True)
+        self._prune_merkle_trees()
 
         # load value from git-sync env file
         if self._repo_use_gitsync_settings:
@@ -86,10 +103,12 @@ class VectorAgent:
         logger.debug("_hold_config_path = {}".format(self._hold_config_path))
         logger.debug("_valid_config_path = {}".format(self._valid_config_path))
         logger.debug("_active_config_path = {}".format(self._active_config_path))
+        logger.debug("_digests_path = {}".format(self._digests_path))
         logger.debug("_vector_bin_path = {}".format(self._vector_bin_path))
         logger.debug("_gitsync_bin_path = {}".format(self._gitsync_bin_path))
         logger.debug("_reload_method = {}".format(self._reload_method))
         logger.debug("_reload_timeout = {}".format(self._reload_timeout))
+        logger.debug("_drift_check_interval = {}".format(self._drift_check_interval))
         logger.debug("_vector_log_path = {}".format(self._vector_bin_path))
         logger.debug("_apply_rules_config_name = {}".format(self._apply_rules_config_name))
         logger.debug("_apply_rules_config_path = {}".format(self._apply_rules_config_path))
@@ -197,6 +216,16 @@ class VectorAgent:
             except KeyError:
                 pass
 
+            try:
+                self._drift_check_interval = int(data["vector-agent"]["drift_check_interval_sec"])
+                if self._drift_check_interval < 0:
+                    raise ValueError
+            except KeyError:
+                pass
+            except (TypeError, ValueError):
+                logger.error("Incorrect drift_check_interval_sec value {}, using default {}".format(data["vector-agent"]["drift_check_interval_sec"], default_drift_check_interval))
+                self._drift_check_interval = default_drift_check_interval
+
     def _load_repo_gitsync_settings(self, env_paths: list):
         vars_dict = {}
         for env_path in env_paths:
@@ -395,9 +424,147 @@ class VectorAgent:
     def _get_synced_hash(self):
         return os.path.basename(os.path.realpath(self._synced_config_path))
 
+    def _get_digest_path(self, config_hash: str):
+        return os.path.join(self._digests_path, config_hash + ".json")
+
+    def _get_merkle_tree(self, config_hash: str):
+        with self._digests_lock:
+            tree = self._merkle_tree_cache.get(config_hash)
+            if tree is None:
+                tree = load_merkle_tree(self._get_digest_path(config_hash))
+                if tree is not None:
+                    self._merkle_tree_cache[config_hash] = tree
+            return tree
+
+    def _save_merkle_tree(self, config_hash: str, tree: dict):
+        with self._digests_lock:
+            save_merkle_tree(tree, self._get_digest_path(config_hash))
+            self._merkle_tree_cache[config_hash] = tree
+
+    def _remove_merkle_tree(self, config_hash: str):
+        with self._digests_lock:
+            self._merkle_tree_cache.pop(config_hash, None)
+            digest_path = self._get_digest_path(config_hash)
+            logger.debug("Removing digest {}".format(digest_path))
+            try:
+                os.remove(digest_path)
+            except FileNotFoundError:
+                pass
+
+    def _prune_merkle_trees(self, keep_hash: str = None):
+        # keep digests of valid snapshots and of the current synced commit only
+        with self._digests_lock:
+            valid_hashes = set(os.listdir(self._valid_config_path)) if os.path.isdir(self._valid_config_path) else set()
+            for name in os.listdir(self._digests_path):
+                config_hash, ext = os.path.splitext(name)
+                if ext == ".json" and config_hash not in valid_hashes and config_hash != keep_hash:
+                    self._remove_merkle_tree(config_hash)
+
+    def _get_synced_merkle_tree(self, config_hash: str):
+        # resolve git-sync link once, so that hash and tree always belong to the same commit
+        synced_path = os.path.realpath(self._synced_config_path)
+        if os.path.basename(synced_path) != config_hash:
+            return None
+        with self._digests_lock:
+            tree = self._get_merkle_tree(config_hash)
+            if tree is None:
+                # git-sync checks out every commit into a new worktree with new mtimes,
+                # so there is no previous tree to reuse: digest is built once per commit
+                logger.debug("Building digest of synced config {}".format(config_hash))
+                tree = build_merkle_tree(synced_path)
+                self._prune_merkle_trees(config_hash)
+                self._save_merkle_tree(config_hash, tree)
+            return tree
+
+    def _set_active_merkle_tree(self, expected_tree: dict):
+        # active config is a copy with preserved mtimes, so only stat() is needed for unchanged files
+        self._active_scan_tree = build_merkle_tree(self._active_config_path, expected_tree)
+        if expected_tree is None:
+            self._active_merkle_tree = self._active_scan_tree
+            self._config_drift = None
+        else:
+            self._active_merkle_tree = expected_tree
+            self._config_drift = self._active_scan_tree["hash"] != expected_tree["hash"]
+            if self._config_drift:
+                logger.error("Active config differs from validated snapshot right after copy")
+
+    def diff_config(self, config_hash: str):
+        result = {}
+        if not re.fullmatch(r"[0-9A-Za-z_-]+", config_hash):
+            result["status"] = "fail"
+            result["reason"] = "incorrect hash"
+            return result
+        if self._active_snapshot_tree is None:
+            result["status"] = "fail"
+            result["reason"] = "no active config"
+            return result
+        if config_hash == self._active_config_hash:
+            target_tree = self._active_snapshot_tree
+        elif os.path.isdir(os.path.join(self._valid_config_path, config_hash)):
+            target_tree = self._get_merkle_tree(config_hash)
+        else:
+            target_tree = self._get_synced_merkle_tree(config_hash)
+        if target_tree is None:
+            result["status"] = "fail"
+            result["reason"] = "config digest not found"
+            return result
+        result = diff_merkle_trees(self._active_snapshot_tree, target_tree)
+        result["status"] = "ok"
+        result["active_hash"] = self._active_config_hash
+        result["target_hash"] = config_hash
+        return result
+
+    def check_config_drift(self):
+        result = {}
+        if not self._lock.acquire(blocking=False):
+            result["status"] = "in_progress"
+            result["reason"] = "drift check or config apply in progress"
+            return result
+        try:
+            if self._active_merkle_tree is None or not os.path.isdir(self._active_config_path):
+                result["status"] = "unknown"
+                result["reason"] = "no active config digest"
+                return result
+            check_start_time = time.perf_counter()
+            self._active_scan_tree = build_merkle_tree(self._active_config_path, self._active_scan_tree)
+            check_duration = time.perf_counter() - check_start_time
+            logger.debug("Drift check duration: {} seconds".format(check_duration))
+            if self._active_scan_tree["hash"] == self._active_merkle_tree["hash"]:
+                self._config_drift = False
+                result["status"] = "ok"
+            else:
+                self._config_drift = True
+                result = diff_merkle_trees(self._active_merkle_tree, self._active_scan_tree)
+                logger.error("Active config drift detected: {}".format(result))
+                result["status"] = "drift"
+            result["duration"] = check_duration
+            return result
+        finally:
+            self._lock.release()
+
+    def _drift_check_loop(self):
+        while True:
+            time.sleep(self._drift_check_interval)
+            try:
+                self.check_config_drift()
+            except Exception:
+                logger.exception("Drift check failed")
+
+    def start_drift_checker(self):
+        if not self._drift_check_interval:
+            logger.info("Periodic drift check disabled")
+            return
+        logger.info("Starting periodic drift check every {} seconds".format(self._drift_check_interval))
+        threading.Thread(target=self._drift_check_loop, daemon=True).start()
+
     def apply_synced_config(self):
+        with self._lock:
+            return self._apply_synced_config()
+
+    def _apply_synced_config(self):
         logger.info("Starting to apply synced config")
-        target_hash = self._get_synced_hash()
+        synced_path = os.path.realpath(self._synced_config_path)
+        target_hash = os.path.basename(synced_path)
         self._synced_config_hash = target_hash
         target_branch = self._get_synced_branch()
         self._synced_git_branch = target_branch
@@ -426,7 +593,9 @@ class VectorAgent:
             logger.info("Make a copy of config (snapshot), snapshot name is synced config hash {}".format(target_hash))
             # /opt/vector-agent/vector-confdir/290348a80a8f8d0074bu233
             hold_snapshot_path = os.path.join(self._hold_config_path, target_hash)
-            shutil.copytree(self._synced_config_path, hold_snapshot_path)
+            shutil.copytree(synced_path, hold_snapshot_path)
+            logger.debug("Building snapshot digest")
+            snapshot_tree = build_merkle_tree(hold_snapshot_path, self._get_merkle_tree(target_hash))
             snapshot_current_path = hold_snapshot_path
             config_to_validate_path = snapshot_current_path
             if config_root_dir:
@@ -440,6 +609,7 @@ class VectorAgent:
                 logger.debug("Moving validated snapshot to validated dir: {}".format(valid_snapshot_path))
                 shutil.move(snapshot_current_path, valid_snapshot_path)
                 snapshot_current_path = valid_snapshot_path
+                self._save_merkle_tree(target_hash, snapshot_tree)
                 logger.debug("Snapshot current path:{}".format(snapshot_current_path))
                 logger.info("Checking if vector service is running")
                 self._refresh_vector_service_status()
@@ -456,6 +626,7 @@ class VectorAgent:
                     shutil.rmtree(self._active_config_path)
                     logger.debug("Replace active config {} with snapshot temp copy {}".format(snapshot_current_copy_path, self._active_config_path))
                     os.replace(snapshot_current_copy_path, self._active_config_path)
+                    self._set_active_merkle_tree(snapshot_tree)
                     vector_reload_success = False
                     reload_start_time = time.perf_counter()
                     if self._reload_method == "manual":
@@ -475,6 +646,8 @@ class VectorAgent:
                         logger.info("Vector config reload duration: {} seconds".format(reload_duration))
                         logger.debug("Remove current active config {}".format(current_active_config_path))
                         shutil.rmtree(current_active_config_path)
+                        self._remove_merkle_tree(self._active_config_hash)
+                        self._active_snapshot_tree = snapshot_tree
                         self._active_git_branch = target_branch
                         self._active_config_hash = target_hash
                         self._apply_status = "successed"
@@ -489,8 +662,10 @@ class VectorAgent:
                         shutil.copytree(current_active_config_path, current_active_config_copy_path)
                         logger.debug("Removing active config {}".format(self._active_config_path))
                         shutil.rmtree(self._active_config_path)
-                        logger.debug("Replace active config {} with temp copy active config {}".format(current_active_config_copy_path))
+                        logger.debug("Replace active config {} with temp copy active config {}".format(self._active_config_path, current_active_config_copy_path))
                         os.replace( current_active_config_copy_path, self._active_config_path)
+                        # whole snapshot is restored, whatever root dir it was activated from
+                        self._set_active_merkle_tree(self._active_snapshot_tree)
                         vector_reload_success = False
                         if self._reload_method == "manual":
                             logger.info("Reload Vector service to trigger config reloading")
@@ -507,6 +682,7 @@ class VectorAgent:
                             p = subprocess.run(["systemctl", "restart", "--quiet", self._vector_systemd_unit])
                         logger.debug("Removing snapshot dir: {}".format(snapshot_current_path))
                         shutil.rmtree(snapshot_current_path)
+                        self._remove_merkle_tree(target_hash)
                         logger.info("Finished to apply synced config")
                         self._apply_status = "failed"
                         return 1
@@ -518,10 +694,12 @@ class VectorAgent:
                         source_path = os.path.join(snapshot_current_path, self._vector_config_root_dir)
                     logger.debug("Copy validated snapshot from {} to {}".format(source_path, self._active_config_path))
                     shutil.copytree(source_path, self._active_config_path)
+                    self._set_active_merkle_tree(get_merkle_subtree(snapshot_tree, self._vector_config_root_dir))
                     logger.info("Trying to start Vector service")
                     p = subprocess.run(["systemctl", "start", "--quiet", self._vector_systemd_unit])
                     if p.returncode == 0:
                         logger.info("Vector successfully started")
+                        self._active_snapshot_tree = snapshot_tree
                         self._active_git_branch = target_branch
                         self._active_config_hash = target_hash
                         self._apply_status = "successed"
@@ -537,6 +715,7 @@ class VectorAgent:
                 logger.info("vector validate output: {}".format(validation_result["output"]))
                 logger.debug("Removing snapshor from dir: {}".format(snapshot_current_path))
                 shutil.rmtree(snapshot_current_path)
+                self._remove_merkle_tree(target_hash)
                 self._apply_status = "failed"
                 logger.info("Finished to apply synced config")
                 return 1
@@ -561,8 +740,12 @@ class VectorAgent:
             vector_service_running = True
         else:
             status_messages.append("Vector systemd service is not running")
+
+        result["config_drift"] = self._config_drift
+        if self._config_drift:
+            status_messages.append("Active config differs from validated snapshot")
         
-        if not vector_running_latest_config or not vector_service_running:
+        if not vector_running_latest_config or not vector_service_running or self._config_drift:
             status = "fail"
         else:
             status = "ok"
@@ -644,5 +827,120 @@ def follow(thefile, timeout_sec):
             continue
         yield line
 
+def hash_file(path: str):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(hash_chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+def build_merkle_tree(path: str, prev_tree: dict = None):
+    """
+    Build Merkle tree of directory: file nodes keep content hash, size and mtime,
+    symlink nodes keep hash of link target and are never followed,
+    dir nodes keep hash of their children's hashes and names.
+    :param path: directory to hash
+    :param prev_tree: previously built tree of the same (or copied) directory,
+        content of files with unchanged size and mtime is not re-read
+    :return: dict {"hash": ..., "children": {name: node}}
+    """
+    prev_children = prev_tree["children"] if prev_tree else {}
+    children = {}
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        prev = prev_children.get(entry.name)
+        if entry.is_symlink():
+            link_hash = hashlib.sha256(os.fsencode(os.readlink(entry.path))).hexdigest()
+            children[entry.name] = {"hash": link_hash, "link": True}
+        elif entry.is_dir(follow_symlinks=False):
+            if prev and "children" not in prev:
+                prev = None
+            children[entry.name] = build_merkle_tree(entry.path, prev)
+        else:
+            st = entry.stat(follow_symlinks=False)
+            if prev and "size" in prev and prev["size"] == st.st_size and prev["mtime_ns"] == st.st_mtime_ns:
+                file_hash = prev["hash"]
+            else:
+                file_hash = hash_file(entry.path)
+            children[entry.name] = {"hash": file_hash, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    h = hashlib.sha256()
+    for name, node in children.items():
+        if "children" in node:
+            kind = b"d"
+        elif node.get("link"):
+            kind = b"l"
+        else:
+            kind = b"f"
+        h.update(kind + b" " + node["hash"].encode("ascii") + b" " + os.fsencode(name) + b"\0")
+    return {"hash": h.hexdigest(), "children": children}
+
+def get_merkle_subtree(tree: dict, rel_path: str):
+    node = tree
+    for part in os.path.normpath(rel_path).split(os.sep):
+        if part == ".":
+            continue
+        node = node.get("children", {}).get(part)
+        if node is None or "children" not in node:
+            return None
+    return node
+
+def _list_merkle_files(node: dict, path: str):
+    if "children" not in node:
+        return [path]
+    result = []
+    for name, child in node["children"].items():
+        result.extend(_list_merkle_files(child, os.path.join(path, name) if path else name))
+    return result
+
+def diff_merkle_trees(old_tree: dict, new_tree: dict, path: str = ""):
+    """
+    Compare two Merkle trees, subtrees with equal hashes are skipped
+    :return: dict with lists of "added", "removed" and "modified" file paths
+    """
+    result = {"added": [], "removed": [], "modified": []}
+    _diff_merkle_nodes(old_tree, new_tree, path, result)
+    return result
+
+def _diff_merkle_nodes(old_node: dict, new_node: dict, path: str, result: dict):
+    if old_node["hash"] == new_node["hash"] and old_node.get("link") == new_node.get("link"):
+        return
+    old_is_dir = "children" in old_node
+    new_is_dir = "children" in new_node
+    if not old_is_dir and not new_is_dir:
+        result["modified"].append(path)
+        return
+    if old_is_dir != new_is_dir:
+        result["removed"].extend(_list_merkle_files(old_node, path))
+        result["added"].extend(_list_merkle_files(new_node, path))
+        return
+    old_children = old_node["children"]
+    new_children = new_node["children"]
+    for name in sorted(old_children.keys() | new_children.keys()):
+        child_path = os.path.join(path, name) if path else name
+        if name not in new_children:
+            result["removed"].extend(_list_merkle_files(old_children[name], child_path))
+        elif name not in old_children:
+            result["added"].extend(_list_merkle_files(new_children[name], child_path))
+        else:
+            _diff_merkle_nodes(old_children[name], new_children[name], child_path, result)
+
+def save_merkle_tree(tree: dict, path: str):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(tree, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def load_merkle_tree(path: str):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
 #x = VectorAgent("/mnt/d/dev/github/vector-agent/app/config.yaml")
 #x.apply_synced_config()
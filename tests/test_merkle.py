@@ -0,0 +1,262 @@
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+import app.utils as f
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fh:
+        fh.write(content)
+
+
+@pytest.fixture
+def config_dir(tmp_path):
+    root = tmp_path / "configs"
+    write(str(root / "a" / "b" / "x.yaml"), "x: 1\n")
+    write(str(root / "c" / "y.yaml"), "y: 2\n")
+    write(str(root / "z.toml"), "z = 3\n")
+    return str(root)
+
+
+def make_agent(tmp_path, **agent_settings):
+    workdir = tmp_path / "workdir"
+    for subdir in ("02-hold", "03-valid"):
+        os.makedirs(workdir / subdir, exist_ok=True)
+    write(str(tmp_path / ".env-vector"), "FOO=bar\n")
+    write(str(tmp_path / "vector.log"), "")
+    config = {
+        "vector": {"log_path": str(tmp_path / "vector.log"), "embedded_config_dirs": []},
+        "vector-agent": {
+            "configs_workdir": str(workdir),
+            "drift_check_interval_sec": 0,
+            "env_files": {"input": [], "output": str(tmp_path / ".env-vector")},
+            "repo": {"use_gitsync_settings": False, "url": "", "ssh_key_path": None, "ssh_known_hosts_path": None},
+            "root_vrl_path_env_name": "VECTOR_CONFIG_PATH",
+        },
+    }
+    config["vector-agent"].update(agent_settings)
+    config_path = tmp_path / "config.yaml"
+    with open(config_path, "w") as fh:
+        yaml.dump(config, fh)
+    return f.VectorAgent(str(config_path))
+
+
+@pytest.fixture
+def agent(tmp_path):
+    return make_agent(tmp_path)
+
+
+def sync_commit(agent, tmp_path, config_hash, files, root_dir="."):
+    commit_dir = str(tmp_path / "git" / config_hash)
+    rules = {"rules": {"all": {"host_patterns": [".*"], "root_dir": root_dir}}}
+    write(os.path.join(commit_dir, "apply-rules.yaml"), yaml.dump(rules))
+    for name, content in files.items():
+        write(os.path.join(commit_dir, name), content)
+    if os.path.lexists(agent._synced_config_path):
+        os.remove(agent._synced_config_path)
+    os.symlink(commit_dir, agent._synced_config_path)
+
+
+class FakeSystemd:
+    def __init__(self, running):
+        self.running = running
+        self.commands = []
+
+    def run(self, cmd, *args, **kwargs):
+        self.commands.append(cmd)
+        returncode = 0
+        if cmd[:2] == ["systemctl", "is-active"]:
+            returncode = 0 if self.running else 1
+        elif cmd[:2] == ["systemctl", "start"]:
+            self.running = True
+        return SimpleNamespace(returncode=returncode)
+
+
+@pytest.fixture
+def systemd(monkeypatch):
+    fake = FakeSystemd(running=False)
+    monkeypatch.setattr(f.subprocess, "run", fake.run)
+    return fake
+
+
+def set_validation(monkeypatch, agent, status):
+    monkeypatch.setattr(agent, "validate_config", lambda path: {"status": status, "output": ""})
+
+
+def set_reload(monkeypatch, reloaded):
+    lines = ["Vector has reloaded\n"] if reloaded else []
+    monkeypatch.setattr(f, "follow", lambda fh, timeout_sec: iter(lines))
+
+
+def test_copy_has_same_hash_without_rehashing(config_dir, tmp_path, monkeypatch):
+    tree = f.build_merkle_tree(config_dir)
+    copy_dir = str(tmp_path / "copy")
+    shutil.copytree(config_dir, copy_dir)
+    hashed = []
+    hash_file = f.hash_file
+    monkeypatch.setattr(f, "hash_file", lambda path: hashed.append(path) or hash_file(path))
+    copy_tree = f.build_merkle_tree(copy_dir, tree)
+    assert copy_tree["hash"] == tree["hash"]
+    assert hashed == []
+
+
+def test_diff_classifies_changes(config_dir):
+    old_tree = f.build_merkle_tree(config_dir)
+    write(os.path.join(config_dir, "a", "b", "x.yaml"), "x: changed\n")
+    os.remove(os.path.join(config_dir, "z.toml"))
+    write(os.path.join(config_dir, "c", "new.yaml"), "n: 1\n")
+    new_tree = f.build_merkle_tree(config_dir, old_tree)
+    assert f.diff_merkle_trees(old_tree, new_tree) == {
+        "added": [os.path.join("c", "new.yaml")],
+        "removed": ["z.toml"],
+        "modified": [os.path.join("a", "b", "x.yaml")],
+    }
+
+
+def test_diff_file_replaced_with_directory(config_dir):
+    old_tree = f.build_merkle_tree(config_dir)
+    os.remove(os.path.join(config_dir, "z.toml"))
+    write(os.path.join(config_dir, "z.toml", "inner.toml"), "i = 1\n")
+    new_tree = f.build_merkle_tree(config_dir, old_tree)
+    assert f.diff_merkle_trees(old_tree, new_tree) == {
+        "added": [os.path.join("z.toml", "inner.toml")],
+        "removed": ["z.toml"],
+        "modified": [],
+    }
+
+
+def test_symlinks_are_not_followed(config_dir):
+    os.symlink(config_dir, os.path.join(config_dir, "loop"))
+    os.symlink("missing.yaml", os.path.join(config_dir, "dangling"))
+    tree = f.build_merkle_tree(config_dir)
+    assert tree["children"]["loop"]["link"]
+    os.remove(os.path.join(config_dir, "dangling"))
+    os.symlink("other.yaml", os.path.join(config_dir, "dangling"))
+    new_tree = f.build_merkle_tree(config_dir, tree)
+    assert f.diff_merkle_trees(tree, new_tree)["modified"] == ["dangling"]
+
+
+def test_get_merkle_subtree(config_dir):
+    tree = f.build_merkle_tree(config_dir)
+    assert f.get_merkle_subtree(tree, ".") is tree
+    assert f.get_merkle_subtree(tree, "a")["hash"] == f.build_merkle_tree(os.path.join(config_dir, "a"))["hash"]
+    assert f.get_merkle_subtree(tree, "z.toml") is None
+    assert f.get_merkle_subtree(tree, "missing") is None
+
+
+def test_check_config_drift(agent, config_dir):
+    assert agent.check_config_drift()["status"] == "unknown"
+    snapshot_tree = f.build_merkle_tree(config_dir)
+    shutil.copytree(config_dir, agent._active_config_path)
+    agent._set_active_merkle_tree(snapshot_tree)
+    assert agent.check_config_drift()["status"] == "ok"
+    write(os.path.join(agent._active_config_path, "c", "y.yaml"), "y: edited manually\n")
+    result = agent.check_config_drift()
+    assert result["status"] == "drift"
+    assert result["modified"] == [os.path.join("c", "y.yaml")]
+    assert agent._config_drift
+
+
+def test_active_copy_mismatch_is_drift(agent, config_dir):
+    snapshot_tree = f.build_merkle_tree(config_dir)
+    shutil.copytree(config_dir, agent._active_config_path)
+    os.remove(os.path.join(agent._active_config_path, "z.toml"))
+    agent._set_active_merkle_tree(snapshot_tree)
+    assert agent._config_drift
+    assert agent.check_config_drift()["removed"] == ["z.toml"]
+
+
+def test_check_config_drift_does_not_wait_for_apply(agent):
+    with agent._lock:
+        assert agent.check_config_drift()["status"] == "in_progress"
+
+
+def test_drift_check_interval_validation(tmp_path):
+    assert make_agent(tmp_path, drift_check_interval_sec=-5)._drift_check_interval == f.default_drift_check_interval
+    assert make_agent(tmp_path, drift_check_interval_sec="often")._drift_check_interval == f.default_drift_check_interval
+    assert make_agent(tmp_path, drift_check_interval_sec="30")._drift_check_interval == 30
+
+
+def test_prune_digests_at_startup(agent, tmp_path):
+    os.makedirs(os.path.join(agent._valid_config_path, "kept"))
+    write(agent._get_digest_path("kept"), "{}")
+    write(agent._get_digest_path("stale"), "{}")
+    make_agent(tmp_path)
+    assert os.path.isfile(agent._get_digest_path("kept"))
+    assert not os.path.isfile(agent._get_digest_path("stale"))
+
+
+def test_apply_on_stopped_vector(agent, tmp_path, systemd, monkeypatch):
+    set_validation(monkeypatch, agent, "ok")
+    sync_commit(agent, tmp_path, "aaa", {"collector/a.yaml": "a: 1\n"}, root_dir="collector")
+    assert agent.apply_synced_config() == 0
+    assert agent._active_config_hash == "aaa"
+    assert os.listdir(agent._active_config_path) == ["a.yaml"]
+    assert os.path.isfile(agent._get_digest_path("aaa"))
+    assert agent.check_config_drift()["status"] == "ok"
+
+
+def test_apply_with_reload(agent, tmp_path, systemd, monkeypatch):
+    set_validation(monkeypatch, agent, "ok")
+    sync_commit(agent, tmp_path, "aaa", {"a.yaml": "a: 1\n"})
+    assert agent.apply_synced_config() == 0
+    set_reload(monkeypatch, True)
+    sync_commit(agent, tmp_path, "bbb", {"a.yaml": "a: 2\n"})
+    assert agent.apply_synced_config() == 0
+    assert agent._active_config_hash == "bbb"
+    assert os.path.isfile(agent._get_digest_path("bbb"))
+    assert not os.path.isfile(agent._get_digest_path("aaa"))
+    assert agent.check_config_drift()["status"] == "ok"
+
+
+def test_reload_failure_restores_previous_config(agent, tmp_path, systemd, monkeypatch):
+    set_validation(monkeypatch, agent, "ok")
+    sync_commit(agent, tmp_path, "aaa", {"collector/a.yaml": "a: 1\n"}, root_dir="collector")
+    assert agent.apply_synced_config() == 0
+    set_reload(monkeypatch, False)
+    sync_commit(agent, tmp_path, "bbb", {"collector/a.yaml": "a: 2\n"}, root_dir="collector")
+    assert agent.apply_synced_config() == 1
+    assert agent._active_config_hash == "aaa"
+    assert not os.path.isdir(os.path.join(agent._valid_config_path, "bbb"))
+    assert not os.path.isfile(agent._get_digest_path("bbb"))
+    assert os.path.isfile(agent._get_digest_path("aaa"))
+    assert not agent._config_drift
+    assert agent.check_config_drift()["status"] == "ok"
+
+
+def test_validation_failure_removes_digest(agent, tmp_path, systemd, monkeypatch):
+    set_validation(monkeypatch, agent, "ok")
+    sync_commit(agent, tmp_path, "aaa", {"a.yaml": "a: 1\n"})
+    assert agent.apply_synced_config() == 0
+    set_validation(monkeypatch, agent, "fail")
+    sync_commit(agent, tmp_path, "bbb", {"a.yaml": "a: broken\n"})
+    assert agent.diff_config("bbb")["status"] == "ok"
+    assert os.path.isfile(agent._get_digest_path("bbb"))
+    assert agent.apply_synced_config() == 1
+    assert not os.path.isfile(agent._get_digest_path("bbb"))
+    assert os.listdir(agent._hold_config_path) == []
+
+
+def test_diff_config(agent, tmp_path, systemd, monkeypatch):
+    assert agent.diff_config("aaa") == {"status": "fail", "reason": "no active config"}
+    set_validation(monkeypatch, agent, "ok")
+    sync_commit(agent, tmp_path, "aaa", {"a.yaml": "a: 1\n", "b.yaml": "b: 1\n"})
+    assert agent.apply_synced_config() == 0
+    sync_commit(agent, tmp_path, "bbb", {"a.yaml": "a: 2\n", "c.yaml": "c: 1\n"})
+
+    result = agent.diff_config("bbb")
+    assert result["status"] == "ok"
+    assert (result["added"], result["removed"], result["modified"]) == (["c.yaml"], ["b.yaml"], ["a.yaml"])
+    assert agent.diff_config("aaa")["modified"] == []
+
+    os.makedirs(os.path.join(agent._valid_config_path, "ccc"))
+    write(agent._get_digest_path("ccc"), '{"hash": "x", "children": {}}')
+    assert agent.diff_config("ccc")["removed"] == ["a.yaml", "apply-rules.yaml", "b.yaml"]
+
+    assert agent.diff_config("unknown") == {"status": "fail", "reason": "config digest not found"}
+    assert agent.diff_config("..") == {"status": "fail", "reason": "incorrect hash"}